@@ -2,12 +2,15 @@ from __future__ import annotations
 
 import sys
 import os
-import random
+import mmap
+import colorsys
 import importlib
 from pathlib import Path
+from struct import Struct
 
 import bpy
 import mathutils
+import numpy as np
 from math import radians
 from mathutils import Vector, Matrix
 
@@ -16,13 +19,19 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 # Import internal modules
 import common
-from common.meshutils import ParseVerts
-from common.io import (
-    ReadSInt16, ReadSInt32, ReadSInt64,
-    ReadUByte, ReadByte, ReadFloat, ReadString
-)
-
-importlib.reload(common.io)
+from common.meshutils import ParseSkinnedVerts, ParseSCMVerts, GroupWeights
+from common.io import ReadArray
+
+# Reload shared helpers only while developing the add-on
+if os.environ.get("DMC3HDC_DEV"):
+    importlib.reload(common.io)
+
+# Fixed-size record layouts, unpacked in one call per record
+_MODEL_HDR = Struct("<4sfqBbbbiqq")
+_OBJECT_HDR = Struct("<bbh4xqi28x4f")
+_MESH_HDR_SKIN = Struct("<hh12xqqqqq8xq8x")
+_MESH_HDR_SCM = Struct("<hh12xqqq16xqq8x")
+_SKELETON_HDR = Struct("<4i")
       
 #=====================================================================
 #   Mesh
@@ -39,44 +48,39 @@ class Mesh:
     weightsOffs: offs_t
     uknOffs: offs_t
     ukn: ubyte
-    positions: list[Vector]
-    normals: list[Vector]
-    UVs: list[Vector]
-    boneIndicies: list[tuple]
-    boneWeights: list[tuple]
-    vertColour: list[tuple]
-    triSkip: list[tuple]
+    positions: np.ndarray
+    normals: np.ndarray
+    UVs: np.ndarray
+    boneIndicies: np.ndarray
+    boneWeights: np.ndarray
+    vertColour: np.ndarray
+    triSkip: np.ndarray
     faces: list
     vertGrp: list
 
     def __init__(self, f: BufferedReader, meshIdx: int):
         self.meshIdx = meshIdx
         self.f = f
-        self.vertCount = ReadSInt16(f)
-        self.texInd = ReadSInt16(f)
-        f.seek(12, 1)
-        self.positionsOffs = ReadSInt64(f)
-        self.normalsOffs = ReadSInt64(f)
-        self.UVsOffs = ReadSInt64(f)
-        
-        if model.Id != "SCM ":
-            self.boneIndiciesOffs = ReadSInt64(f)
-            self.weightsOffs = ReadSInt64(f)
-            f.seek(8, 1)
+        skinned: bool = model.Id != "SCM "
+
+        if skinned:
+            (self.vertCount, self.texInd,
+             self.positionsOffs, self.normalsOffs, self.UVsOffs,
+             self.boneIndiciesOffs, self.weightsOffs,
+             self.ukn) = _MESH_HDR_SKIN.unpack(f.read(_MESH_HDR_SKIN.size))
         else:
-            f.seek(16, 1)
-            self.uknOffs = ReadSInt64(f)
-        
-        self.ukn = ReadSInt64(f)
-        f.seek(8, 1)
+            (self.vertCount, self.texInd,
+             self.positionsOffs, self.normalsOffs, self.UVsOffs,
+             self.uknOffs,
+             self.ukn) = _MESH_HDR_SCM.unpack(f.read(_MESH_HDR_SCM.size))
        
-        self.positions = [Vector]*self.vertCount
-        self.normals = []
-        self.UVs = []
-        self.boneIndicies = []
-        self.boneWeights = []
-        self.vertColour = []
-        self.triSkip = []
+        self.positions = np.empty((self.vertCount, 3), dtype=np.float32)
+        self.normals = np.empty((self.vertCount, 3), dtype=np.float32)
+        self.UVs = np.empty((self.vertCount, 2), dtype=np.float32)
+        self.boneIndicies = np.empty((self.vertCount if skinned else 0, 3), dtype=np.uint8)
+        self.boneWeights = np.empty((self.vertCount if skinned else 0, 3), dtype=np.float32)
+        self.vertColour = np.empty((0 if skinned else self.vertCount, 4), dtype=np.float32)
+        self.triSkip = np.empty(self.vertCount, dtype=np.uint8)
         self.faces = []
         self.vertGrp = [None]*model.boneCount
     
@@ -100,17 +104,9 @@ class Object:
     def __init__(self, f: BufferedReader, objectIdx: int):
         self.f = f
         self.objectIdx = objectIdx
-        self.meshCount = ReadByte(f)
-        self.ukn = ReadByte(f)
-        self.numVerts = ReadSInt16(f)
-        ReadSInt32(f)
-        self.mshOffs = ReadSInt64(f)
-        self.flags = ReadSInt32(f)
-        f.seek(28, 1)
-        self.X = ReadFloat(f)
-        self.Y = ReadFloat(f)
-        self.Z = ReadFloat(f)
-        self.radius = ReadFloat(f)
+        (self.meshCount, self.ukn, self.numVerts,
+         self.mshOffs, self.flags,
+         self.X, self.Y, self.Z, self.radius) = _OBJECT_HDR.unpack(f.read(_OBJECT_HDR.size))
         # self.meshes = []
 
 
@@ -136,43 +132,47 @@ class Bone:
 
 
 class Skeleton:
-    bones: list[Bone]
+    positions: np.ndarray
+    parent_idx: np.ndarray
     
     
     def __init__(self, f: BufferedReader, boneCount: int):
         base_offset = f.tell()
         self.f = f
         self.boneCount = boneCount
-        self.hierarchyOffs = ReadSInt32(f)
-        self.hierarchyOrderOffs = ReadSInt32(f)
-        self.childIdxOffs = ReadSInt32(f)
-        self.transformsOffs = ReadSInt32(f)
-        self.bones = []
+        (self.hierarchyOffs, self.hierarchyOrderOffs,
+         self.childIdxOffs, self.transformsOffs) = _SKELETON_HDR.unpack(f.read(_SKELETON_HDR.size))
 
         # Collect bone hierarchy parents
         f.seek(base_offset + self.hierarchyOffs)
-        self.hierarchy = [ ReadByte(f) for _ in range(boneCount) ]
+        self.hierarchy = ReadArray(f, 'i1', boneCount)
 
         # Collect hierarchy indices
         f.seek(base_offset + self.hierarchyOrderOffs)
-        self.hierarchyOrder = [ ReadByte(f) for _ in range(boneCount) ]
+        self.hierarchyOrder = ReadArray(f, 'i1', boneCount)
 
         # Collect child object indices
         f.seek(base_offset + self.childIdxOffs)
-        self.childIndices = [ ReadByte(f) for _ in range(boneCount) ]
+        self.childIndices = ReadArray(f, 'i1', boneCount)
 
-        # Collect bone transforms
+        # Collect bone transforms (position followed by 0x14 unused bytes)
         f.seek(base_offset + self.transformsOffs)
-
-        for i in range(boneCount):
-            self.bones.append( Bone( Vector( [ReadFloat(f), ReadFloat(f), ReadFloat(f)] ), i) )
-            f.seek(0x14, os.SEEK_CUR)
+        self.positions = np.ascontiguousarray( ReadArray(f, 'f4', 8 * boneCount).reshape(-1, 8)[:, :3] )
 
         # remap the ownership
-        self.parents = [ -1 for _ in range(boneCount)]
+        self.parent_idx = np.full(boneCount, -1, dtype=np.int16)
+        self.parent_idx[self.hierarchyOrder] = self.hierarchy
 
-        for i in range(boneCount):
-            self.bones[self.hierarchyOrder[i]].parent = self.hierarchy[i]
+    @property
+    def bones(self) -> list[Bone]:
+        bones: list[Bone] = []
+
+        for i in range(self.boneCount):
+            bone = Bone( Vector(self.positions[i]), i )
+            bone.parent = int(self.parent_idx[i])
+            bones.append(bone)
+
+        return bones
 
 
 #=====================================================================
@@ -184,16 +184,11 @@ class Model:
 
     def __init__(self, f: BufferedReader):
         self.f = f
-        self.Id = ReadString(f, 4)
-        self.version = ReadFloat(f)
-        self.padding = ReadSInt64(f)
-        self.objectCount = ReadUByte(f)
-        self.boneCount = ReadByte(f)
-        self.numTex = ReadByte(f)
-        self.uknByte = ReadByte(f)
-        self.ukn = ReadSInt32(f)
-        self.ukn2 = ReadSInt64(f)
-        self.skeletonOffs = ReadSInt64(f)
+        (Id, self.version, self.padding,
+         self.objectCount, self.boneCount, self.numTex, self.uknByte,
+         self.ukn, self.ukn2, self.skeletonOffs) = _MODEL_HDR.unpack(f.read(_MODEL_HDR.size))
+        self.Id = Id.decode("utf-8")
+        self.vertParser = ParseSCMVerts if self.Id == "SCM " else ParseSkinnedVerts
         self.objects = []
         self.skeleton: Skeleton
 
@@ -212,7 +207,7 @@ class Model:
 
     def ParseObjectVerts(self, obj: Object):
         for mesh in obj.meshes:
-            ParseVerts(mesh, self.f, self)
+            self.vertParser(mesh, self.f)
 
     def ParseSkeleton(self):
         self.f.seek(self.skeletonOffs)
@@ -239,44 +234,64 @@ correction_mat: Matrix = Matrix([
 correction_local = mathutils.Euler((radians(90), 0, radians(0))).to_matrix().to_4x4()
 correction_global = mathutils.Euler((radians(-90), radians(0), 0)).to_matrix().to_4x4()
 
+#=====================================================================
+#   Compute bone tails from absolute heads
+#=====================================================================
+def compute_tails(heads: np.ndarray, parents: np.ndarray) -> np.ndarray:
+    up: np.ndarray = np.array((0.0, 10.0, 0.0), dtype=heads.dtype)
+    has_parent: np.ndarray = parents != -1
+
+    # Average child heads per bone
+    child_count: np.ndarray = np.bincount(parents[has_parent], minlength=len(heads))
+    child_sum: np.ndarray = np.zeros_like(heads)
+    np.add.at(child_sum, parents[has_parent], heads[has_parent])
+
+    # Leaf bones extend away from their parent, or straight up if unparented
+    tails: np.ndarray = heads + up
+    leaf: np.ndarray = (child_count == 0) & has_parent
+    tails[leaf] = heads[leaf] + (heads[leaf] - heads[parents[leaf]]) * 0.5
+
+    # Bones with children point at their average, halfway when there are several
+    branch: np.ndarray = child_count > 0
+    avg: np.ndarray = child_sum[branch] / child_count[branch, None]
+    factor: np.ndarray = np.where(child_count[branch] > 1, 0.5, 0.0)[:, None]
+    tails[branch] = avg + (heads[branch] - avg) * factor
+
+    # Avoid zero length bones
+    tails[np.linalg.norm(tails - heads, axis=1) <= 0.0005] += up
+
+    return tails
+
 #=====================================================================
 #   Setup armature
 #=====================================================================
-def setup_bones(context, armature: bpy.types.Armature, joints: list[Bone], armature_object: bpy.types.Object) -> list[bpy.types.EditBone]:
+def setup_bones(context, armature: bpy.types.Armature, skeleton: Skeleton, armature_object: bpy.types.Object, bone_names: tuple[str, ...]) -> list[bpy.types.EditBone]:
     bones: list[bpy.types.EditBone] = []
 
+    # Accumulate absolute head positions, parents first
+    parents: np.ndarray = skeleton.parent_idx
+    heads: np.ndarray = skeleton.positions.copy()
+
+    for i in skeleton.hierarchyOrder:
+        if parents[i] != -1:
+            heads[i] += heads[parents[i]]
+
+    tails: np.ndarray = compute_tails(heads, parents)
+
     bpy.ops.object.mode_set(mode='EDIT')
 
     # Create bones
-    for joint in joints:
-        bone = armature.edit_bones.new(f"bone_{joint.idx}")
-        bone.head = Vector([joint.position.x, joint.position.y, joint.position.z])
+    for i in range(skeleton.boneCount):
+        bone = armature.edit_bones.new(bone_names[i])
+        bone.head = Vector(heads[i])
+        bone.tail = Vector(tails[i])
         bone.use_relative_parent = True
         bones.append(bone)
 
     # Set up parent relationships
-    for i, joint in enumerate(joints):
-        bone = bones[i]
-        if joint.parent != -1:
-            bone.parent = bones[joint.parent]
-            bone.head += bone.parent.head
-
-    # Set tails
-    for bone in armature.edit_bones:
-        if bone.children:
-            avg = Vector((0.0, 0.0, 0.0))
-            for child in bone.children:
-                avg += child.head
-            avg /= len(bone.children)
-            bone.tail = avg.lerp(bone.head, 0.5 if len(bone.children) > 1 else 0.0)
-        else:
-            if bone.parent:
-                bone.tail = bone.head + (bone.head - bone.parent.head) * 0.5
-            else:
-                bone.tail = bone.head + Vector((0.0, 10.0, 0.0))
-
-        if bone.length <= 0.0005:
-            bone.tail += Vector((0.0, 10.0, 0.0))
+    for i, parent in enumerate(parents):
+        if parent != -1:
+            bones[i].parent = bones[parent]
 
     # Apply basis matrix if defined
     if 'basis_mat' in globals():
@@ -289,8 +304,9 @@ def setup_bones(context, armature: bpy.types.Armature, joints: list[Bone], armat
 #=====================================================================
 # Setup objects 
 #=====================================================================
-def setup_objects(Mod: Model, model_collection: bpy.types.Collection, armature_object: bpy.types.Object) -> list[bpy.types.Object]:
+def setup_objects(Mod: Model, model_collection: bpy.types.Collection, armature_object: bpy.types.Object, bone_names: tuple[str, ...], compute_tangents: bool = False) -> list[bpy.types.Object]:
     objects: list[bpy.types.Object] = []
+    pending: list[bpy.types.Object] = []
 
     # Create or fetch vertex color material
     material_vert_col: bpy.types.Material = bpy.data.materials.get("Baked Lighting")
@@ -306,78 +322,88 @@ def setup_objects(Mod: Model, model_collection: bpy.types.Collection, armature_o
         links: bpy.types.NodeLinks = material_vert_col.node_tree.links
         links.new(vert_col_node.outputs[0], mat_out.inputs[0])
 
+    meshes_new = bpy.data.meshes.new
+    objects_new = bpy.data.objects.new
+    link = model_collection.objects.link
+    mesh_num: int = 0
+
     for i, obj in enumerate(Mod.objects):
         for j, msh in enumerate(obj.meshes):
+            mesh_num += 1
             name: str = f"Object:{i}_Mesh:{j}_Tex:{msh.texInd}"
-            mesh_data: bpy.types.Mesh = bpy.data.meshes.new(name)
-            mesh_data.from_pydata(msh.positions, [], msh.faces)
+            mesh_data: bpy.types.Mesh = meshes_new(name)
+
+            # Build geometry, one loop per triangle corner
+            loop_verts: np.ndarray = np.asarray(msh.faces, dtype=np.int32).ravel()
+            mesh_data.vertices.add(len(msh.positions))
+            mesh_data.vertices.foreach_set("co", msh.positions.ravel())
+            mesh_data.loops.add(len(loop_verts))
+            mesh_data.loops.foreach_set("vertex_index", loop_verts)
+            mesh_data.polygons.add(len(loop_verts) // 3)
+            mesh_data.polygons.foreach_set("loop_start", np.arange(0, len(loop_verts), 3, dtype=np.int32))
+            mesh_data.update(calc_edges=True)
 
-            mesh_object: bpy.types.Object = bpy.data.objects.new(name, mesh_data)
+            mesh_object: bpy.types.Object = objects_new(name, mesh_data)
 
             if j > 0:
-                mesh_object.parent = object
+                mesh_object.parent = root_object
             else:
-                object = mesh_object
-                objects.append(object)
+                root_object = mesh_object
+                objects.append(root_object)
 
-            model_collection.objects.link(mesh_object)
-            bpy.context.view_layer.objects.active = mesh_object
+            pending.append(mesh_object)
 
             # Set custom normals
-            custom_normals: list = []
-            for face in mesh_data.polygons:
-                for vert_index in face.vertices:
-                    custom_normals.append(msh.normals[vert_index])
-                face.use_smooth = True
-            mesh_data.normals_split_custom_set(custom_normals)
+            mesh_data.polygons.foreach_set("use_smooth", np.ones(len(mesh_data.polygons), dtype=bool))
+            mesh_data.normals_split_custom_set(msh.normals[loop_verts].tolist())
 
             # Setup UVs
-            if msh.UVs:
-                mesh_data.uv_layers.new(name='UV_0')
-                uv_data = mesh_data.uv_layers[0].data
-                for u in range(len(uv_data)):
-                    uv_data[u].uv = msh.UVs[mesh_data.loops[u].vertex_index]
-                mesh_data.calc_tangents(uvmap="UV_0")
+            if len(msh.UVs):
+                uv_layer = mesh_data.uv_layers.new(name='UV_0')
+                uv_layer.data.foreach_set("uv", msh.UVs[loop_verts].astype(np.float32, copy=False).ravel())
 
-            # Create vertex groups for bones
-            for b in range(Mod.skeleton.boneCount):
-                mesh_object.vertex_groups.new(name=f"bone_{b}")
+                # Only needed for normal mapping, stages are vertex lit
+                if compute_tangents and Mod.Id != "SCM ":
+                    mesh_data.calc_tangents(uvmap="UV_0")
 
             # Weight painting
             if Mod.Id != "SCM ":
-                for vert in mesh_data.vertices:
-                    v = vert.index
-                    bone_indices = msh.boneIndicies[v]
-                    weights = msh.boneWeights[v]
-                    for idx, b in enumerate(bone_indices):
-                        vgroup = mesh_object.vertex_groups[b]
-                        vgroup.add([v], weights[idx], 'REPLACE')
+                # Create vertex groups for bones
+                vg_new = mesh_object.vertex_groups.new
+                vgroups: list[bpy.types.VertexGroup] = [vg_new(name=bone_name) for bone_name in bone_names]
+
+                for b, weight, verts in GroupWeights(msh.boneIndicies, msh.boneWeights):
+                    vgroups[b].add(verts, weight, 'REPLACE')
 
                 material = bpy.data.materials.new(name=mesh_object.name)
-                material.diffuse_color = [random.uniform(0.0, 1.0) for _ in range(3)] + [1.0]
+                # Spread hues with a multiplicative hash so re-imports get the same colours
+                hue: float = ((mesh_num * 2654435761) & 0xFFFFFFFF) / 2**32
+                material.diffuse_color = list(colorsys.hsv_to_rgb(hue, 0.6, 0.9)) + [1.0]
                 mesh_data.materials.append(material)
 
             else:
                 vcol_layer = mesh_data.vertex_colors.new(name='Baked Lighting')
-                for loop, col in zip(mesh_data.loops, vcol_layer.data):
-                    col.color = msh.vertColour[loop.vertex_index]
+                vcol_layer.data.foreach_set("color", msh.vertColour[loop_verts].ravel())
                 mesh_data.materials.append(material_vert_col)
 
             mesh_data.transform(basis_mat)
 
             # Attach to armature
-            bpy.ops.object.mode_set(mode='OBJECT')
             modifier = mesh_object.modifiers.new(type='ARMATURE', name="Armature")
             modifier.object = armature_object
 
-        object.parent = armature_object
+        root_object.parent = armature_object
+
+    # Link once everything is built so the scene is only updated at the end
+    for mesh_object in pending:
+        link(mesh_object)
 
     return objects
 
 #=====================================================================
 #   Setup parsed models
 #=====================================================================
-def setup_model(context: bpy.types.Context, filepath: Path, Mod: Model) -> None:
+def setup_model(context: bpy.types.Context, filepath: Path, Mod: Model, compute_tangents: bool = False) -> None:
     # Setup collection
     file_name: str = Path(filepath).name
     model_collection: bpy.types.Collection = bpy.data.collections.new(file_name)
@@ -394,19 +420,19 @@ def setup_model(context: bpy.types.Context, filepath: Path, Mod: Model) -> None:
     context.view_layer.objects.active = armature_object
 
     # Setup bones
-    joints: list[Bone] = Mod.skeleton.bones
-    bones: list[bpy.types.EditBone] = setup_bones(context, armature, joints, armature_object)
+    bone_names: tuple[str, ...] = tuple(sys.intern(f"bone_{i}") for i in range(Mod.boneCount))
+    bones: list[bpy.types.EditBone] = setup_bones(context, armature, Mod.skeleton, armature_object, bone_names)
 
     # Setup objects
-    objects: list[bpy.types.Object] = setup_objects(Mod, model_collection, armature_object)
+    objects: list[bpy.types.Object] = setup_objects(Mod, model_collection, armature_object, bone_names, compute_tangents)
 
     if Mod.Id != "MOD ":
         bpy.context.view_layer.objects.active = armature_object
         bpy.ops.object.mode_set(mode='POSE')
 
-        for i, child_idx in enumerate(Mod.skeleton.childIndices):
+        for i, child_idx in enumerate(Mod.skeleton.childIndices.tolist()):
             if child_idx != -1:
-                bone: bpy.types.PoseBone = armature_object.pose.bones[f"bone_{i}"]
+                bone: bpy.types.PoseBone = armature_object.pose.bones[bone_names[i]]
                 obj: bpy.types.Object = objects[child_idx]
 
                 obj.parent_type = 'BONE'
@@ -422,14 +448,14 @@ def setup_model(context: bpy.types.Context, filepath: Path, Mod: Model) -> None:
 #=====================================================================
 #   Import
 #=====================================================================
-def Import(context: bpy.types.Context, filepath: Path):
-    with open(filepath, 'rb') as f:
+def Import(context: bpy.types.Context, filepath: Path, compute_tangents: bool = False):
+    with open(filepath, 'rb') as raw, mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as f:
         global model
         model = Model(f)
         model.ParseObjects()
         model.ParseMeshes()
         model.ParseVerts()
         model.ParseSkeleton()
-        setup_model(context, filepath, model)
+        setup_model(context, filepath, model, compute_tangents)
 
     return {'FINISHED'}
\ No newline at end of file
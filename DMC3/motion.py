@@ -17,7 +17,9 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import common
 from common.io import ReadUInt16, ReadUInt32, ReadFloat, ReadSInt32
 from common.scene import frame_timeline
-importlib.reload(common.io)
+# Reload shared helpers only while developing the add-on
+if os.environ.get("DMC3HDC_DEV"):
+    importlib.reload(common.io)
 
 #=====================================================================
 
@@ -11,7 +11,7 @@ bl_info = {
 import bpy
 from bpy.types import Operator, Menu
 from bpy_extras.io_utils import ImportHelper
-from bpy.props import StringProperty
+from bpy.props import StringProperty, BoolProperty
 
 # Auto-reload internal modules
 if "DMC3" in locals():
@@ -32,9 +32,14 @@ class DMC3_OT_import_model(Operator, ImportHelper):
     bl_label = "DMC3 Model/Stage (.mod/.scm)"
     filename_ext = ".mod"
     filter_glob: StringProperty(default="*.mod;*.scm", options={'HIDDEN'})
+    compute_tangents: BoolProperty(
+        name="Compute Tangents",
+        description="Calculate UV tangents for normal mapping (slower on large models)",
+        default=False,
+    )
 
     def execute(self, context):
-        model.Import(context, self.filepath)
+        model.Import(context, self.filepath, self.compute_tangents)
         return {'FINISHED'}
 
 
@@ -3,6 +3,7 @@ from io import BufferedReader, BufferedWriter
 from struct import pack, unpack
 from typing import NewType, TypeVar
 
+import numpy as np
 from mathutils import *
 from numpy import byte, int16, int32, int64, ubyte, uint16, uint32, uint64
 
@@ -138,6 +139,12 @@ def ReadSInt64(f: BufferedReader, endian: Endian = Endian.LITTLE) -> int64:  #si
 def ReadFloat(f: BufferedReader, endian: Endian = Endian.LITTLE) -> float: 
     return unpack( endian + 'f', f.read(4) )[0]
 
+
+# Array
+def ReadArray(f: BufferedReader, dtype, count: int, endian: Endian = Endian.LITTLE) -> np.ndarray:
+    dt = np.dtype(dtype).newbyteorder(endian)
+    return np.frombuffer( f.read(dt.itemsize * count), dtype=dt, count=count )
+
 #endregion
 
 
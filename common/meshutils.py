@@ -4,6 +4,7 @@ import sys
 import os
 import bpy
 import importlib
+import numpy as np
 from io import BufferedReader
 from mathutils import Vector
 from typing import TYPE_CHECKING
@@ -16,14 +17,16 @@ if TYPE_CHECKING:
     import DMC3.motion
 
 import common.io
-from common.io import ReadFloat, ReadSInt16, ReadByte, ReadUByte
+from common.io import ReadArray
 
-importlib.reload(common.io)
+# Reload shared helpers only while developing the add-on
+if os.environ.get("DMC3HDC_DEV"):
+    importlib.reload(common.io)
 
 #=====================================================================
 #   Generate faces from triangle strips
 #=====================================================================
-def GetTris(verts: list[Vector], nrmls: list[Vector], triSkip: list[int], numVerts: int) -> list:
+def GetTris(verts: list[list[float]], nrmls: list[list[float]], triSkip: list[int], numVerts: int) -> list:
     tris: list[tuple] = []
     p1: int = 0
     p2: int = 1
@@ -70,55 +73,83 @@ def GetTris(verts: list[Vector], nrmls: list[Vector], triSkip: list[int], numVer
     return tris
 
 
+#=====================================================================
+#   Group vertex weights into (bone, weight, vertices) buckets
+#=====================================================================
+def GroupWeights(boneIndicies: np.ndarray, boneWeights: np.ndarray):
+    verts = np.arange(len(boneIndicies))
+
+    if not len(verts):
+        return
+
+    # one influence slot at a time, so later slots still replace earlier ones
+    for slot in range(boneIndicies.shape[1]):
+        bones = boneIndicies[:, slot]
+        weights = boneWeights[:, slot]
+
+        order = np.lexsort((weights, bones))
+        bones, weights, slotVerts = bones[order], weights[order], verts[order]
+
+        starts = np.flatnonzero( (bones[1:] != bones[:-1]) | (weights[1:] != weights[:-1]) ) + 1
+        starts = np.concatenate(([0], starts))
+
+        for start, vs in zip(starts, np.split(slotVerts, starts[1:])):
+            yield int(bones[start]), float(weights[start]), vs.tolist()
+
+
 #=====================================================================
 #   Vertex decoding
 #=====================================================================
-def ParseVerts(self: DMC3.model.Mesh, f: BufferedReader, modelHdr) -> None:
+def ParseVertStreams(self: DMC3.model.Mesh, f: BufferedReader) -> None:
     #POSITIONS
     f.seek(self.positionsOffs)
-    self.positions = [ Vector([ReadFloat(f), ReadFloat(f), ReadFloat(f)]) for _ in range(self.vertCount) ]
+    self.positions[:] = ReadArray(f, 'f4', 3 * self.vertCount).reshape(-1, 3)
  
     #NORMALS
     f.seek(self.normalsOffs)
-    self.normals = [ Vector([ReadFloat(f), ReadFloat(f), ReadFloat(f)]) for _ in range(self.vertCount) ]
+    self.normals[:] = ReadArray(f, 'f4', 3 * self.vertCount).reshape(-1, 3)
     
     #TEXTURE COORDINATES
     f.seek(self.UVsOffs)
-    self.UVs = [ Vector([ReadSInt16(f)/4096., (1. - ReadSInt16(f)/4096.)]) for _ in range(self.vertCount) ]
+    self.UVs[:] = ReadArray(f, 'i2', 2 * self.vertCount).reshape(-1, 2)
+    self.UVs /= 4096.
+    self.UVs[:, 1] = 1. - self.UVs[:, 1]
 
 
-    #BONE INDICES
-    if modelHdr.Id != "SCM ":
-        f.seek(self.boneIndiciesOffs)
-
-        for _ in range(self.vertCount):
-            ReadByte(f)
-            self.boneIndicies.append( [ReadUByte(f)//4, ReadUByte(f)//4, ReadUByte(f)//4] )
+# Skinned models (bone indices + weights)
+def ParseSkinnedVerts(self: DMC3.model.Mesh, f: BufferedReader) -> None:
+    ParseVertStreams(self, f)
 
+    #BONE INDICES
+    f.seek(self.boneIndiciesOffs)
+    indices = ReadArray(f, 'u1', 4 * self.vertCount).reshape(-1, 4)
+    self.boneIndicies[:] = indices[:, 1:] // 4
 
-        #BONE WEIGHTS
-        f.seek(self.weightsOffs)
+    #BONE WEIGHTS (3x 5 bit weights + strip restart flag)
+    f.seek(self.weightsOffs)
+    w = ReadArray(f, 'u2', self.vertCount)
 
-        for _ in range(self.vertCount):
-            w = ReadSInt16(f)
+    self.boneWeights[:, 0] = w & 0x1f
+    self.boneWeights[:, 1] = (w >> 5) & 0x1f
+    self.boneWeights[:, 2] = (w >> 10) & 0x1f
+    self.boneWeights /= 31.
+    self.triSkip[:] = w >> 15
 
-            w1 = (w & 0x1f) / 31.
-            w2 = ( (w >> 5) & 0x1f) / 31.
-            w3 = ( (w >> 10) & 0x1f) / 31.
+    # FACES
+    self.faces = GetTris(self.positions.tolist(), self.normals.tolist(), self.triSkip.tolist(), self.vertCount)
 
-            self.triSkip.append( (w >> 15) & 1 )
-            self.boneWeights.append( [w1, w2, w3] )
 
-        # FACES
-        self.faces = GetTris(self.positions, self.normals, self.triSkip, self.vertCount)
+# Stage geometry (baked vertex colours)
+def ParseSCMVerts(self: DMC3.model.Mesh, f: BufferedReader) -> None:
+    ParseVertStreams(self, f)
 
     # VERTEX COLOUR
-    else:
-        f.seek(self.uknOffs)
+    f.seek(self.uknOffs)
+    colours = ReadArray(f, 'u1', 4 * self.vertCount).reshape(-1, 4)
 
-        for _ in range(self.vertCount):
-            self.vertColour.append( (ReadUByte(f)/255., ReadUByte(f)/255., ReadUByte(f)/255., 1.) )
-            self.triSkip.append(ReadUByte(f) & 2)
+    self.vertColour[:, :3] = colours[:, :3] / 255.
+    self.vertColour[:, 3] = 1.
+    self.triSkip[:] = colours[:, 3] & 2
 
-        # FACES
-        self.faces = GetTris(self.positions, self.normals, self.triSkip, self.vertCount)
\ No newline at end of file
+    # FACES
+    self.faces = GetTris(self.positions.tolist(), self.normals.tolist(), self.triSkip.tolist(), self.vertCount)